@@ -1,13 +1,80 @@
 from astropy.io import fits
+from functools import lru_cache, partial
+import gzip
+from math import cos, sin
+from multiprocessing import cpu_count
 import os
 from tqdm import tqdm
+from tqdm.contrib.concurrent import process_map
 import numpy as np
 from numpy.typing import NDArray
-from typing import List
+from typing import List, Tuple
 
 from opticam.utils.constants import bar_format
 
 
+@lru_cache(maxsize=4)
+def _get_pixel_coordinates(
+    shape: Tuple[int, int],
+    ) -> Tuple[NDArray, NDArray]:
+    """
+    Get the pixel coordinates of an image as a row vector of x-coordinates and a column vector of y-coordinates, which
+    broadcast against each other to the image shape. Results are cached per shape, so the returned arrays are
+    read-only.
+    
+    Parameters
+    ----------
+    shape : Tuple[int, int]
+        The shape of the image.
+    
+    Returns
+    -------
+    Tuple[NDArray, NDArray]
+        The x-coordinates with shape (1, W) and the y-coordinates with shape (H, 1).
+    """
+    
+    x = np.arange(shape[1], dtype=np.float32)[np.newaxis, :]
+    y = np.arange(shape[0], dtype=np.float32)[:, np.newaxis]
+    x.flags.writeable = False
+    y.flags.writeable = False
+    
+    return x, y
+
+def _get_gaussian_coefficients(
+    sigma_x: float,
+    sigma_y: float,
+    theta: float,
+    ) -> Tuple[float, float, float]:
+    """
+    Get the coefficients of the quadratic form a*x^2 + 2*b*x*y + c*y^2 in the exponent of a rotated 2D Gaussian.
+    
+    Parameters
+    ----------
+    sigma_x : float
+        The standard deviation of the Gaussian in the x-direction.
+    sigma_y : float
+        The standard deviation of the Gaussian in the y-direction.
+    theta : float
+        The rotation angle of the Gaussian.
+    
+    Returns
+    -------
+    Tuple[float, float, float]
+        The coefficients a, b, and c. b is zero when the Gaussian is axis-aligned or circular, in which case it is
+        separable.
+    """
+    
+    if theta == 0 or sigma_x == sigma_y:
+        return 1/(2*sigma_x**2), 0., 1/(2*sigma_y**2)
+    
+    cos_theta, sin_theta = cos(theta), sin(theta)
+    
+    a = cos_theta**2/(2*sigma_x**2) + sin_theta**2/(2*sigma_y**2)
+    b = sin_theta*cos_theta*(1/(2*sigma_y**2) - 1/(2*sigma_x**2))
+    c = sin_theta**2/(2*sigma_x**2) + cos_theta**2/(2*sigma_y**2)
+    
+    return a, b, c
+
 def _add_two_dimensional_gaussian_to_image(
     image: NDArray,
     x_centroid: float,
@@ -18,7 +85,7 @@ def _add_two_dimensional_gaussian_to_image(
     theta: float,
     ) -> NDArray:
     """
-    Add a source to an image.
+    Add a source to an image in place.
     
     Parameters
     ----------
@@ -40,18 +107,107 @@ def _add_two_dimensional_gaussian_to_image(
     Returns
     -------
     NDArray
-        The image with the source added.
+        The image with the source added (the same array as `image`).
     """
     
-    x, y = np.meshgrid(np.arange(image.shape[1]), np.arange(image.shape[0]))
+    # only evaluate the source within 6 sigma of its centroid, beyond which its flux is negligible
+    r = int(np.ceil(6*max(sigma_x, sigma_y)))
+    x0, x1 = max(0, int(x_centroid) - r), min(image.shape[1], int(x_centroid) + r + 1)
+    y0, y1 = max(0, int(y_centroid) - r), min(image.shape[0], int(y_centroid) + r + 1)
+    
+    if x0 >= x1 or y0 >= y1:
+        return image  # source lies entirely outside the image
     
-    a = np.cos(theta)**2/(2*sigma_x**2) + np.sin(theta)**2/(2*sigma_y**2)
-    b = -np.sin(2*theta)/(4*sigma_x**2) + np.sin(2*theta)/(4*sigma_y**2)
-    c = np.sin(theta)**2/(2*sigma_x**2) + np.cos(theta)**2/(2*sigma_y**2)
+    cutout = image[y0:y1, x0:x1]
     
-    gaussian = peak_flux*np.exp(-(a*(x - x_centroid)**2 + 2*b*(x - x_centroid)*(y - y_centroid) + c*(y - y_centroid)**2))
+    # broadcast row and column offsets rather than building full coordinate grids
+    x, y = _get_pixel_coordinates(image.shape)
+    dx = x[:, x0:x1] - x_centroid
+    dy = y[y0:y1, :] - y_centroid
     
-    return image + gaussian
+    a, b, c = _get_gaussian_coefficients(sigma_x, sigma_y, theta)
+    
+    if b == 0:
+        # Gaussians without a cross term are separable, so only 1D profiles need to be evaluated
+        gx = np.exp(-a*dx*dx)
+        gy = np.exp(-c*dy*dy)
+        cutout += peak_flux*gy*gx
+        
+        return image
+    
+    # build the exponent in a single cutout-sized buffer (the other terms are 1D and broadcast into it), then
+    # exponentiate and scale in place rather than allocating a new temporary for every operation
+    exponent = (-2*b*dx)*dy
+    exponent -= a*dx*dx
+    exponent -= c*dy*dy
+    np.exp(exponent, out=exponent)
+    exponent *= peak_flux
+    cutout += exponent
+    
+    return image
+
+def _add_two_dimensional_gaussians_to_image(
+    image: NDArray,
+    x_centroids: NDArray,
+    y_centroids: NDArray,
+    peak_fluxes: NDArray,
+    sigma_x: float,
+    sigma_y: float,
+    theta: float,
+    ) -> NDArray:
+    """
+    Add several sources with a common PSF to an image in place.
+    
+    Parameters
+    ----------
+    image : NDArray
+        The image.
+    x_centroids : NDArray
+        The x-coordinates of the sources.
+    y_centroids : NDArray
+        The y-coordinates of the sources.
+    peak_fluxes : NDArray
+        The peak fluxes of the sources.
+    sigma_x : float
+        The standard deviation of the sources in the x-direction.
+    sigma_y : float
+        The standard deviation of the sources in the y-direction.
+    theta : float
+        The rotation angle of the sources.
+    
+    Returns
+    -------
+    NDArray
+        The image with the sources added (the same array as `image`).
+    """
+    
+    a, b, c = _get_gaussian_coefficients(sigma_x, sigma_y, theta)
+    
+    if b != 0:
+        # sources with a cross term are not separable, so add them one at a time
+        for x_centroid, y_centroid, peak_flux in zip(x_centroids, y_centroids, peak_fluxes):
+            _add_two_dimensional_gaussian_to_image(
+                image,
+                x_centroid,
+                y_centroid,
+                peak_flux,
+                sigma_x,
+                sigma_y,
+                theta,
+                )
+        
+        return image
+    
+    # evaluate the separable 1D profiles of every source at once, then sum their outer products in a single
+    # (H x N) @ (N x W) matrix multiplication
+    x, y = _get_pixel_coordinates(image.shape)
+    dx = x - x_centroids.astype(np.float32)[:, np.newaxis]
+    dy = y.T - y_centroids.astype(np.float32)[:, np.newaxis]
+    gx = np.exp(-a*dx*dx)
+    gy = np.exp(-c*dy*dy)
+    image += (peak_fluxes.astype(np.float32)[:, np.newaxis]*gy).T @ gx
+    
+    return image
 
 def _variable_function(
     i: float,
@@ -99,14 +255,15 @@ def _create_image(
         The noisy image.
     """
     
-    return np.zeros((int(2048 / binning_scale), int(2048 / binning_scale))) + 100
+    # single precision comfortably covers the dynamic range of the synthetic data and halves the memory traffic
+    return np.full((int(2048 / binning_scale), int(2048 / binning_scale)), 100., dtype=np.float32)
 
 def _add_noise(
     image: NDArray,
     i: int,
     ) -> NDArray:
     """
-    Add Poisson noise to an image.
+    Add Poisson noise to an image in place.
     
     Parameters
     ----------
@@ -123,12 +280,48 @@ def _add_noise(
     
     rng = np.random.default_rng(i)
     
-    return rng.normal(image, np.sqrt(image))
+    # draw unit normals in bulk and scale them in place, rather than broadcasting full-size loc and scale arrays
+    # through rng.normal() and casting its double precision output (this consumes the generator identically)
+    noise = rng.standard_normal(image.shape)
+    noise *= np.sqrt(image)
+    image += noise
+    
+    return image
+
+def _write_fits(
+    hdu: fits.PrimaryHDU,
+    file_path: str,
+    ) -> None:
+    """
+    Write an HDU to a gzip-compressed FITS file, replacing any existing file.
+    
+    Parameters
+    ----------
+    hdu : fits.PrimaryHDU
+        The HDU.
+    file_path : str
+        The path to the file.
+    """
+    
+    # write to a temporary file first so that an interrupted write never leaves a truncated file behind (which would
+    # otherwise be skipped as already existing when overwrite=False)
+    temp_file_path = f"{file_path}.tmp"
+    
+    try:
+        # astropy compresses .gz files at the maximum level, which is much slower for noisy float data while barely
+        # reducing the file size, so compress at the fastest level instead
+        with gzip.open(temp_file_path, 'wb', compresslevel=1) as file:
+            # the headers are built here from known-valid keywords, so skip verification and checksums
+            hdu.writeto(file, output_verify='ignore', checksum=False)
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        if os.path.isfile(temp_file_path):
+            os.remove(temp_file_path)
+        raise
 
 def _create_images(
     out_dir: str,
     filters: List[str],
-    N_sources: int,
     variable_source: int,
     source_positions: NDArray,
     peak_fluxes: NDArray,
@@ -144,8 +337,6 @@ def _create_images(
     ----------
     filters : List[str]
         The filters.
-    N_sources : int
-        The number of sources.
     variable_source : int
         The index of the variable source.
     source_positions : NDArray
@@ -162,51 +353,55 @@ def _create_images(
         Whether to overwrite the image if it already exists.
     """
     
+    filters = [fltr for fltr in filters
+               if overwrite or not os.path.isfile(f"{out_dir}/240101{fltr}{200000000 + i}o.fits.gz")]
+    
+    if not filters:
+        return
+    
+    # generate base image (shared by all filters since the noise is seeded by the image index)
+    image = _create_image(binning_scale)
+    if circular_aperture:
+        image = _apply_flat_field(image)  # apply circular aperture shadow
+    base_image = _add_noise(image, i)  # add Poisson noise
+    
+    # PSF parameters
+    semimajor_sigma = base_image.shape[0] // 256
+    semiminor_sigma = base_image.shape[1] // 256
+    orientation = 0
+    
+    # (x, y) translations
+    rng = np.random.default_rng(i)
+    dx = rng.normal()
+    dy = rng.normal()
+    x_positions = source_positions[:, 0] + dx
+    y_positions = source_positions[:, 1] + dy
+    
+    # put the constant sources in the base image, since they are identical in every filter
+    is_constant = np.arange(peak_fluxes.size) != variable_source
+    _add_two_dimensional_gaussians_to_image(
+        base_image,
+        x_positions[is_constant],
+        y_positions[is_constant],
+        peak_fluxes[is_constant],
+        semimajor_sigma,
+        semiminor_sigma,
+        orientation,
+        )
+    
     for fltr in filters:
-        if os.path.isfile(f"{out_dir}/240101{fltr}{200000000 + i}o.fits.gz") and not overwrite:
-            continue
-        
-        # generate image
-        image = _create_image(binning_scale)
-        if circular_aperture:
-            image = _apply_flat_field(image)  # apply circular aperture shadow
-        noisy_image = _add_noise(image, i)  # add Poisson noise
-        
-        # PSF parameters
-        semimajor_sigma = noisy_image.shape[0] // 256
-        semiminor_sigma = noisy_image.shape[1] // 256
-        orientation = 0
+        noisy_image = base_image.copy()
         
-        # (x, y) translations
-        rng = np.random.default_rng(i)
-        dx = rng.normal()
-        dy = rng.normal()
-        x_positions = source_positions[:, 0] + dx
-        y_positions = source_positions[:, 1] + dy
-        
-        # put sources in the image
-        for j in range(N_sources):
-            
-            if j == variable_source:
-                noisy_image = _add_two_dimensional_gaussian_to_image(
-                    noisy_image,
-                    x_positions[j],
-                    y_positions[j],
-                    peak_fluxes[j] + _variable_function(i, fltr),  # add variable flux to the source
-                    semimajor_sigma,
-                    semiminor_sigma,
-                    orientation,
-                    )
-            else:
-                noisy_image = _add_two_dimensional_gaussian_to_image(
-                    noisy_image,
-                    x_positions[j],
-                    y_positions[j],
-                    peak_fluxes[j],
-                    semimajor_sigma,
-                    semiminor_sigma,
-                    orientation,
-                    )
+        # only the variable source differs between filters
+        _add_two_dimensional_gaussian_to_image(
+            noisy_image,
+            x_positions[variable_source],
+            y_positions[variable_source],
+            peak_fluxes[variable_source] + _variable_function(i, fltr),  # add variable flux to the source
+            semimajor_sigma,
+            semiminor_sigma,
+            orientation,
+            )
         
         # create fits file
         hdu = fits.PrimaryHDU(noisy_image)
@@ -225,13 +420,42 @@ def _create_images(
         hdu.header["UT"] = f"2024-01-01 {hh}:{mm}:{ss}"
         
         # save fits file
-        try:
-            hdu.writeto(
-                f"{out_dir}/240101{fltr}{200000000 + i}o.fits.gz",
-                overwrite=overwrite,
-                )
-        except:
-            pass
+        _write_fits(hdu, f"{out_dir}/240101{fltr}{200000000 + i}o.fits.gz")
+
+@lru_cache(maxsize=4)
+def _get_flat_field_falloff(
+    shape: Tuple[int, int],
+    ) -> NDArray:
+    """
+    Get the multiplicative falloff of a circular aperture shadow. The falloff only depends on the image shape, so it is
+    cached and returned as a read-only array.
+    
+    Parameters
+    ----------
+    shape : Tuple[int, int]
+        The shape of the image.
+    
+    Returns
+    -------
+    NDArray
+        The falloff, which is 1 inside the aperture and (radius / distance)^2 outside it.
+    """
+    
+    # squared distance from the image centre (avoids a square root)
+    x, y = _get_pixel_coordinates(shape)
+    x_mid, y_mid = shape[1] // 2, shape[0] // 2
+    distance_squared = (x_mid - x)**2 + (y_mid - y)**2
+    radius_squared = (shape[0] // 2)**2
+    
+    falloff = np.divide(
+        radius_squared,
+        distance_squared,
+        out=np.ones(shape, dtype=np.float32),
+        where=distance_squared >= radius_squared,
+        )
+    falloff.flags.writeable = False  # protect the cached array from modification
+    
+    return falloff
 
 def _apply_flat_field(
     image: NDArray,
@@ -250,18 +474,7 @@ def _apply_flat_field(
         The image with a circular aperture shadow.
     """
     
-    # define mask to apply circular aperture
-    x_mid, y_mid = image.shape[1] // 2, image.shape[0] // 2
-    distance_from_centre = np.sqrt((x_mid - np.arange(image.shape[1]))**2 +
-                                   (y_mid - np.arange(image.shape[0]))[:, np.newaxis]**2)
-    radius = image.shape[0] // 2
-    mask = distance_from_centre >= radius
-    
-    # create circular aperture shadow
-    falloff = 1 / (distance_from_centre[mask] / radius)**2
-    
-    # apply circular aperture shadow
-    image[mask] *= falloff
+    image *= _get_flat_field_falloff(image.shape)
     
     return image
 
@@ -289,16 +502,18 @@ def _create_flats(
         Whether to overwrite the flat-field image if it already exists.
     """
     
+    filters = [fltr for fltr in filters if overwrite or not os.path.isfile(f"{out_dir}/{fltr}-band_flat_{i}.fits.gz")]
+    
+    if not filters:
+        return
+    
+    # create flat-field image (shared by all filters since the noise is seeded by the image index)
+    image = _create_image(binning_scale)
+    image = _apply_flat_field(image)  # apply circular aperture shadow
+    noisy_image = _add_noise(image, 123 * (i + 123))  # ensure different noise from observation images
+    
     for fltr in filters:
         
-        if os.path.isfile(f"{out_dir}/{fltr}-band_image_{i}.fits.gz") and not overwrite:
-            continue
-        
-        # create flat-field image
-        image = _create_image(binning_scale)
-        image = _apply_flat_field(image)  # apply circular aperture shadow
-        noisy_image = _add_noise(image, 123 * (i + 123))  # ensure different noise from observation images
-        
         # create fits file
         hdu = fits.PrimaryHDU(noisy_image)
         hdu.header["FILTER"] = fltr
@@ -312,16 +527,14 @@ def _create_flats(
         hdu.header["UT"] = f"2024-01-01 {hh}:{mm}:{ss}"
         
         # save fits file
-        try:
-            hdu.writeto(f"{out_dir}/{fltr}-band_flat_{i}.fits.gz", overwrite=overwrite)
-        except:
-            pass
+        _write_fits(hdu, f"{out_dir}/{fltr}-band_flat_{i}.fits.gz")
 
 def generate_flats(
     out_dir: str,
     n_flats: int = 5,
     binning_scale: int = 4,
     overwrite: bool = False,
+    number_of_processors: int = max(1, cpu_count() // 2),
     ) -> None:
     """
     Create synthetic flat-field images.
@@ -336,6 +549,8 @@ def generate_flats(
         The binning scale of the flat-field images, by default 4 (512x512).
     overwrite : bool, optional
         Whether to overwrite data if they currently exist, by default False.
+    number_of_processors : int, optional
+        The number of processors to use for parallel processing, by default half the number of available processors.
     """
     
     # create directory if it does not exist
@@ -344,14 +559,21 @@ def generate_flats(
     
     filters = ["g", "r", "i"]
     
-    for i in tqdm(range(n_flats), desc="Generating flats", bar_format=bar_format):
-        _create_flats(
+    # flats are independent of one another, so they can be created in parallel
+    process_map(
+        partial(
+            _create_flats,
             out_dir,
             filters,
-            i,
-            binning_scale,
-            overwrite,
-            )
+            binning_scale=binning_scale,
+            overwrite=overwrite,
+            ),
+        range(n_flats),
+        max_workers=number_of_processors,
+        desc="Generating flats",
+        bar_format=bar_format,
+        tqdm_class=tqdm,
+        )
 
 def generate_observations(
     out_dir: str,
@@ -359,6 +581,7 @@ def generate_observations(
     circular_aperture: bool = True,
     binning_scale: int = 4,
     overwrite: bool = False,
+    number_of_processors: int = max(1, cpu_count() // 2),
     ) -> None:
     """
     Create synthetic observation data for testing and following the tutorials.
@@ -375,6 +598,8 @@ def generate_observations(
         The binning scale of the images, by default 4 (512x512).
     overwrite : bool, optional
         Whether to overwrite data if they currently exist, by default False.
+    number_of_processors : int, optional
+        The number of processors to use for parallel processing, by default half the number of available processors.
     """
     
     # create directory if it does not exist
@@ -392,19 +617,25 @@ def generate_observations(
     
     print(f'[OPTICAM] variable source is at ({source_positions[variable_source][0]:.0f}, {source_positions[variable_source][1]:.0f})')
     
-    for i in tqdm(range(n_images), desc="Generating observations", bar_format=bar_format):
-        _create_images(
+    # images are independent of one another (each is seeded by its index), so they can be created in parallel
+    process_map(
+        partial(
+            _create_images,
             out_dir,
             filters,
-            N_sources,
             variable_source,
             source_positions,
             peak_fluxes,
-            i,
-            binning_scale,
-            circular_aperture,
-            overwrite
-            )
+            binning_scale=binning_scale,
+            circular_aperture=circular_aperture,
+            overwrite=overwrite,
+            ),
+        range(n_images),
+        max_workers=number_of_processors,
+        desc="Generating observations",
+        bar_format=bar_format,
+        tqdm_class=tqdm,
+        )
 
 
 def generate_gappy_observations(
@@ -413,6 +644,7 @@ def generate_gappy_observations(
     circular_aperture: bool = True,
     binning_scale: int = 4,
     overwrite: bool = False,
+    number_of_processors: int = max(1, cpu_count() // 2),
     ) -> None:
     """
     Create synthetic observation data for testing and following the tutorials.
@@ -429,6 +661,8 @@ def generate_gappy_observations(
         The binning scale of the images, by default 4 (512x512).
     overwrite : bool, optional
         Whether to overwrite data if they currently exist, by default False.
+    number_of_processors : int, optional
+        The number of processors to use for parallel processing, by default half the number of available processors.
     """
     
     # create directory if it does not exist
@@ -447,8 +681,9 @@ def generate_gappy_observations(
     print(f'[OPTICAM] variable source is at ({source_positions[variable_source][0]:.0f}, {source_positions[variable_source][1]:.0f})')
     
     gap_probability = .01  # probability of skipping an image
+    image_indices = []
     
-    for i in tqdm(range(n_images), desc="Generating observations", bar_format=bar_format):
+    for i in range(n_images):
         
         # randomly skip some images to create gaps
         if rng.random() < gap_probability:
@@ -458,17 +693,26 @@ def generate_gappy_observations(
         else:
             gap_probability = .01  # reset the probability of skipping the next image
         
-        _create_images(
+        image_indices.append(i)
+    
+    # images are independent of one another (each is seeded by its index), so they can be created in parallel
+    process_map(
+        partial(
+            _create_images,
             out_dir,
             filters,
-            N_sources,
             variable_source,
             source_positions,
             peak_fluxes,
-            i,
-            binning_scale,
-            circular_aperture,
-            overwrite
-            )
+            binning_scale=binning_scale,
+            circular_aperture=circular_aperture,
+            overwrite=overwrite,
+            ),
+        image_indices,
+        max_workers=number_of_processors,
+        desc="Generating observations",
+        bar_format=bar_format,
+        tqdm_class=tqdm,
+        )
 
 